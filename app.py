@@ -8,7 +8,13 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 import io
 import os
+import sys
 import datetime
+import hashlib
+import math
+import shutil
+import tempfile
+import time
 
 # --- 0. ログイン機能 ---
 def check_password():
@@ -54,23 +60,72 @@ except:
 # --- OpenAIクライアントの準備 ---
 client = OpenAI(api_key=OPENAI_API_KEY)
 
+# --- 容量設定の取得 (Secrets → 環境変数 → 既定値の順) ---
+def get_limit_mb(name, default):
+    try:
+        value = st.secrets.get(name, os.environ.get(name, default))
+    except Exception:
+        value = os.environ.get(name, default)
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return float(default)
+    # 0以下や数値でない値は既定値に戻す
+    if not math.isfinite(value) or value <= 0:
+        return float(default)
+    return value
+
+# PDFはメモリに保持せず、一時フォルダに内容ハッシュ名で1度だけ書き出して全セッションで共有する
+PDF_STORE_DIR = os.path.join(tempfile.gettempdir(), "english_app_pdf_store")
+PDF_STORE_MAX_BYTES = int(get_limit_mb("PDF_STORE_MAX_MB", 200) * 1024 * 1024)
+PDF_STORE_TMP_MAX_AGE = 600  # 書き出し途中で止まった .tmp を消すまでの秒数
+# 履歴1件は2〜10KB程度なので、1MBでおよそ100〜500件
+HISTORY_MEMORY_LIMIT_BYTES = int(get_limit_mb("HISTORY_MEMORY_LIMIT_MB", 1) * 1024 * 1024)
+
 # --- セッションステート初期化 ---
 if 'history' not in st.session_state:
     st.session_state.history = []
 if 'current_data' not in st.session_state:
     st.session_state.current_data = None
 
+# --- セッションのメモリ使用量 (履歴テキストの概算) ---
+# PDFはダウンロード時にだけ読み込むため、セッションが常に保持しているのは履歴のテキストのみ
+def estimate_history_memory():
+    total = 0
+    seen = set()
+    for item in st.session_state.history + [st.session_state.current_data]:
+        # current_data は履歴の要素と同じオブジェクトのことが多いので二重に数えない
+        if item is None or id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item) + sum(sys.getsizeof(v) for v in item.values())
+    return total
+
+def enforce_history_memory_limit():
+    # 上限を超えたら、表示中のもの以外の古い履歴から削除する
+    used = estimate_history_memory()
+    while used > HISTORY_MEMORY_LIMIT_BYTES and len(st.session_state.history) > 1:
+        # 内容が同じ履歴があっても表示中のものを消さないよう、位置で削除する
+        index = 1 if st.session_state.history[0] is st.session_state.current_data else 0
+        del st.session_state.history[index]
+        used = estimate_history_memory()
+    st.session_state['history_memory_bytes'] = used
+    return used
+
 # --- サイドバー ---
 st.sidebar.success(f"ログイン中: {st.session_state['user_id']} 先生")
 if st.sidebar.button("ログアウト"):
     st.session_state['password_correct'] = False
     st.session_state['user_id'] = None
     st.rerun()
+history_memory = enforce_history_memory_limit()
+st.sidebar.caption(f"🧠 履歴テキストのメモリ: {history_memory / 1024:.1f} KB / 上限 {HISTORY_MEMORY_LIMIT_BYTES / 1024 / 1024:g} MB")
 st.sidebar.divider()
 
 # --- PDF関数 ---
-def create_pdf(problem_text):
-    buffer = io.BytesIO()
+def create_pdf(problem_text, output=None):
+    # output にファイルパスを渡すとメモリを経由せず直接ファイルに書き出す
+    buffer = output if output is not None else io.BytesIO()
     p = canvas.Canvas(buffer, pagesize=A4)
     # フォント設定
     font_name = "Helvetica"
@@ -126,9 +181,104 @@ def create_pdf(problem_text):
                 y = 800
                 
     p.save()
+    if output is not None:
+        return output
     buffer.seek(0)
     return buffer
 
+# --- PDF保存領域 (内容ハッシュでキャッシュ、容量超過時は古い順に削除) ---
+def evict_pdf_store(keep_path):
+    try:
+        entries = []
+        tmp_total = 0
+        now = time.time()
+        for name in os.listdir(PDF_STORE_DIR):
+            if not name.endswith((".pdf", ".tmp")):
+                continue
+            path = os.path.join(PDF_STORE_DIR, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith(".tmp"):
+                # 書き出し中のものは容量に数え、途中で止まって残った古いものは消す
+                if now - stat.st_mtime > PDF_STORE_TMP_MAX_AGE:
+                    try:
+                        os.remove(path)
+                        continue
+                    except OSError:
+                        pass
+                tmp_total += stat.st_size
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    except OSError:
+        return
+
+    total = tmp_total + sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= PDF_STORE_MAX_BYTES:
+            break
+        if path == keep_path:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # 他のセッションが開いている (Windows) などで消せないものは残す
+            continue
+        total -= size
+
+def get_pdf_path(problem_text):
+    # フォントの有無で出力が変わるため、キーに含める
+    font_flag = "ipaexg" if os.path.exists("ipaexg.ttf") else "helvetica"
+    key = hashlib.sha256(f"{font_flag}\n{problem_text}".encode("utf-8")).hexdigest()
+    path = os.path.join(PDF_STORE_DIR, f"{key}.pdf")
+
+    if os.path.exists(path):
+        try:
+            os.utime(path, None)  # 最近使ったものとして削除対象から遠ざける
+            return path
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return path
+
+    os.makedirs(PDF_STORE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=PDF_STORE_DIR)
+    os.close(fd)
+    try:
+        create_pdf(problem_text, tmp_path)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # 同じ内容を別セッションが先に書き出し、開いている場合はそちらを使う
+            if not os.path.exists(path):
+                raise
+    finally:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    evict_pdf_store(path)
+    return path
+
+def read_pdf(problem_text):
+    # 他セッションの削除と競合した場合は作り直す
+    try:
+        with open(get_pdf_path(problem_text), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        with open(get_pdf_path(problem_text), "rb") as f:
+            return f.read()
+
+def copy_pdf(problem_text, dest_path):
+    # 他セッションの削除と競合した場合は作り直す
+    try:
+        shutil.copyfile(get_pdf_path(problem_text), dest_path)
+    except FileNotFoundError:
+        shutil.copyfile(get_pdf_path(problem_text), dest_path)
+
 # --- 画面レイアウト ---
 st.title("英語問題生成ソフト")
 
@@ -599,6 +749,7 @@ if st.button("✨ 問題を作成する", use_container_width=True):
             
             st.session_state.history.append(new_data)
             st.session_state.current_data = new_data
+            enforce_history_memory_limit()
             st.rerun()
 
     except Exception as e:
@@ -623,13 +774,6 @@ if st.session_state.current_data is not None:
         edited_a_text = st.text_area("解答（編集可）", value=data['a_text'], height=400)
         st.session_state.current_data['a_text'] = edited_a_text
     
-    pdf_q = create_pdf(edited_q_text)
-    pdf_a = create_pdf(edited_a_text)
-    
-    # BytesIOからバイトデータを取得（再利用のため）
-    pdf_q_bytes = pdf_q.getvalue()
-    pdf_a_bytes = pdf_a.getvalue()
-    
     st.divider()
     
     # --- ファイル名設定 ---
@@ -642,11 +786,12 @@ if st.session_state.current_data is not None:
         default_filename_base = f"{now_str}_{sanitized_topic}"
         filename_base = st.text_input("保存時のファイル名 (拡張子不要)", value=default_filename_base, key="filename_input")
 
+    # PDFはボタンが押されたときにだけ保存領域から読み込む（再実行のたびにメモリへ載せない）
     col1, col2 = st.columns(2)
     with col1:
-        st.download_button("⬇️ 問題PDF (ブラウザ保存)", pdf_q_bytes, file_name=f"{filename_base}_問題.pdf", mime="application/pdf")
+        st.download_button("⬇️ 問題PDF (ブラウザ保存)", lambda text=edited_q_text: read_pdf(text), file_name=f"{filename_base}_問題.pdf", mime="application/pdf")
     with col2:
-        st.download_button("⬇️ 解答PDF (ブラウザ保存)", pdf_a_bytes, file_name=f"{filename_base}_解答.pdf", mime="application/pdf")
+        st.download_button("⬇️ 解答PDF (ブラウザ保存)", lambda text=edited_a_text: read_pdf(text), file_name=f"{filename_base}_解答.pdf", mime="application/pdf")
 
     st.divider()
     
@@ -676,10 +821,8 @@ if st.session_state.current_data is not None:
                 q_file_path = os.path.join(save_folder, f"{filename_base}_問題.pdf")
                 a_file_path = os.path.join(save_folder, f"{filename_base}_解答.pdf")
                 
-                with open(q_file_path, "wb") as f:
-                    f.write(pdf_q_bytes)
-                with open(a_file_path, "wb") as f:
-                    f.write(pdf_a_bytes)
+                copy_pdf(edited_q_text, q_file_path)
+                copy_pdf(edited_a_text, a_file_path)
                     
                 st.success(f"✅ 保存しました！\n\n問題: {q_file_path}\n解答: {a_file_path}")
             except Exception as e:
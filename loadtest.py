@@ -0,0 +1,477 @@
+"""複数の先生が同時に使う状況を再現する負荷テスト
+
+Streamlit の AppTest で app.py を画面なしで動かし、N人の先生が
+ログイン → 文法選択 → 問題作成 → 編集 → ダウンロード → 保存 を同時に行う。
+OpenAI API の代わりにローカルのスタブサーバーを立て、応答の遅延を指定できる。
+
+使い方:
+    python loadtest.py --teachers 1,5,10,20 --latency 2.0
+
+人数ごとにスループット、再実行(rerun)のレイテンシ分位点、ピークメモリを表示する。
+各人数は別プロセスで実行し、前の人数で確保したメモリが次の結果に混ざらないようにする。
+生成したPDFは使い捨ての一時フォルダに書き出し、本番の保存領域には触れない。
+失敗した先生が1人でもいれば終了コード1を返す。
+
+Streamlit の内部APIを差し替えて動かすため、動作確認済みのバージョン
+(TESTED_STREAMLIT_VERSION) 以外では起動時にエラーで止まる。
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import streamlit as st
+from streamlit import config
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.runtime.scriptrunner.script_runner import ScriptRunner
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest
+
+# 下の内部APIの差し替えはこのバージョンで確認している
+TESTED_STREAMLIT_VERSION = "1.66"
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, "app.py")
+SEPARATOR_MARK = "|||SPLIT|||"
+
+PROBLEM_TYPES = ["🔠 4択問題", "✏️ 空欄補充問題", "🔀 並び替え問題", "和訳問題", "英訳問題"]
+GRADE1_ITEMS = ["be動詞", "一般動詞（規則）", "疑問詞", "命令文", "代名詞", "三人称単数"]
+
+
+# --- AppTest を複数スレッドで同時に動かすための調整 ---
+# AppTest は1件ずつ実行する前提で作られており、実行のたびに
+#   - 新しい ScriptCache を作って app.py をコンパイルし直す
+#     (Python 3.11 では複数スレッドで同時に ast.parse すると失敗することがある)
+#   - Runtime のシングルトンを差し替え、終了時に None に戻す
+#   - 設定 global.appTest を一時的に True にして、終了時に元へ戻す
+#   - どのセッションも同じセッションID ("test session id") で動く
+# ため、そのままでは並列に動かせない。本番のサーバーも1プロセスで
+# コンパイル1回・Runtime 1つなので、どちらも全セッションで共有する。
+# global.appTest は最初から True にしておき、戻されても影響が出ないようにする。
+# セッションIDは先生ごとに分け、ダウンロード用のメディア領域が混ざらないようにする。
+_shared_script_cache = ScriptCache()
+_original_get_bytecode = ScriptCache.get_bytecode
+_original_runner_init = ScriptRunner.__init__
+_pinned_runtime = None
+_current_session = threading.local()
+
+
+def _get_shared_bytecode(self, script_path):
+    return _original_get_bytecode(_shared_script_cache, script_path)
+
+
+def _get_pinned_runtime(cls):
+    global _pinned_runtime
+    if _pinned_runtime is None:
+        if cls._instance is None:
+            raise RuntimeError("Runtime hasn't been created!")
+        _pinned_runtime = cls._instance
+    return _pinned_runtime
+
+
+def _pinned_runtime_exists(cls):
+    return _pinned_runtime is not None or cls._instance is not None
+
+
+def _runner_init_with_session_id(self, *args, session_id, **kwargs):
+    session_id = getattr(_current_session, "id", session_id)
+    _original_runner_init(self, *args, session_id=session_id, **kwargs)
+
+
+def install_concurrency_patches():
+    config.set_option("global.appTest", True)
+    ScriptCache.get_bytecode = _get_shared_bytecode
+    ScriptRunner.__init__ = _runner_init_with_session_id
+    Runtime.instance = classmethod(_get_pinned_runtime)
+    Runtime.exists = classmethod(_pinned_runtime_exists)
+
+    # 最初の1回を単独で実行し、共有する Runtime を確定させる
+    at = AppTest.from_file(APP_PATH)
+    at.run()
+    Runtime.instance()
+
+
+# --- OpenAI互換のスタブサーバー ---
+def start_stub_server(latency, jitter):
+    counter = {"n": 0}
+    lock = threading.Lock()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            with lock:
+                counter["n"] += 1
+                n = counter["n"]
+
+            time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+            # 毎回異なる内容を返し、PDFのキャッシュが常に当たらないようにする
+            questions = "\n".join(
+                f"{i}. I ( ______ ) a student. [{n}]\n(私は生徒です。)\n(A) am (B) is (C) are (D) be"
+                for i in range(1, 6)
+            )
+            answers = "\n".join(f"{i}. (A) am 解説: 主語が I なので am を使う。" for i in range(1, 6))
+            content = f"タイトル: 負荷テスト {n}\n\n{questions}\n\n{SEPARATOR_MARK}\n\n【解答・解説】\n{answers}"
+
+            payload = json.dumps({
+                "id": f"chatcmpl-stub-{n}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "stub"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }).encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- メモリ計測 (RSSを一定間隔でサンプリング) ---
+def _windows_rss_bytes():
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    kernel32 = ctypes.WinDLL("kernel32")
+    psapi = ctypes.WinDLL("psapi")
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    psapi.GetProcessMemoryInfo.argtypes = [
+        wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD
+    ]
+    if not psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.WorkingSetSize
+
+
+def current_rss_bytes():
+    # 計測できない環境では None を返し、結果は「n/a」と表示する
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    if sys.platform == "win32":
+        try:
+            return _windows_rss_bytes()
+        except (OSError, AttributeError):
+            return None
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    # /proc がない環境 (macOS など) ではプロセス開始からの最大値で代用する。
+    # 人数ごとに別プロセスで動かすので、その人数での最大値になる
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class MemorySampler:
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.start = current_rss_bytes()
+        self.peak = self.start
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        rss = current_rss_bytes()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    @property
+    def growth(self):
+        if self.start is None or self.peak is None:
+            return None
+        return self.peak - self.start
+
+
+# --- 先生1人分の操作 ---
+def find_by_label(elements, label):
+    for element in elements:
+        if element.label == label:
+            return element
+    raise LookupError(f"要素が見つかりません: {label}")
+
+
+def simulate_teacher(teacher_id, password, save_dir, timeout, result):
+    timings = result["timings"]
+    _current_session.id = teacher_id
+
+    def timed_run(at):
+        start = time.perf_counter()
+        at.run(timeout=timeout)
+        timings.append(time.perf_counter() - start)
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    timed_run(at)
+
+    # ログイン
+    at.text_input[0].input(teacher_id)
+    at.text_input[1].input(password)
+    at.button[0].click()
+    timed_run(at)
+    if not at.session_state["password_correct"]:
+        raise RuntimeError("ログインに失敗しました")
+
+    # 文法項目と問題形式の選択
+    find_by_label(at.multiselect, "中1項目").set_value(random.sample(GRADE1_ITEMS, 2))
+    timed_run(at)
+    find_by_label(at.radio, "問題形式を選択").set_value(random.choice(PROBLEM_TYPES))
+    timed_run(at)
+
+    # 問題作成 (スタブモデルを呼び出す)
+    find_by_label(at.button, "✨ 問題を作成する").click()
+    timed_run(at)
+    if at.session_state["current_data"] is None:
+        raise RuntimeError("問題が生成されませんでした")
+
+    # 編集
+    q_area = find_by_label(at.text_area, "問題（編集可）")
+    q_area.input(q_area.value + f"\n(編集: {teacher_id})")
+    timed_run(at)
+
+    # ダウンロード (ボタンが押されたときと同じく、遅延登録されたPDFの読み込みを実行する)
+    download_buttons = at.get("download_button")
+    if len(download_buttons) < 2:
+        raise RuntimeError("ダウンロードボタンが表示されませんでした")
+    media_file_mgr = Runtime.instance().media_file_mgr
+    for button in download_buttons:
+        url = media_file_mgr.execute_deferred(button.proto.deferred_file_id)
+        # メディア領域にこのセッション用として載ったPDFのバイト数
+        result["download_bytes"] += len(media_file_mgr._storage.get_file(os.path.basename(url)).content)
+
+    # フォルダへの保存
+    at.text_input(key="filename_input").input(teacher_id)
+    at.text_input(key="folder_input").input(save_dir)
+    timed_run(at)
+    find_by_label(at.button, "💾 指定フォルダに保存").click()
+    timed_run(at)
+    if not os.path.exists(os.path.join(save_dir, f"{teacher_id}_問題.pdf")):
+        raise RuntimeError("PDFが保存されませんでした")
+
+    result["history_memory"] = at.session_state["history_memory_bytes"]
+
+
+# --- 集計 ---
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # nearest-rank 法
+    index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_level(n_teachers, passwords, timeout):
+    results = [
+        {"timings": [], "error": None, "history_memory": 0, "download_bytes": 0}
+        for _ in range(n_teachers)
+    ]
+
+    def worker(i):
+        try:
+            simulate_teacher(f"teacher{i}", passwords[f"teacher{i}"], save_dir, timeout, results[i])
+        except Exception as e:
+            results[i]["error"] = f"{type(e).__name__}: {e}"
+
+    with tempfile.TemporaryDirectory() as save_dir:
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_teachers)]
+        with MemorySampler() as sampler:
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            wall = time.perf_counter() - start
+
+    timings = [t for r in results for t in r["timings"]]
+    ok = sum(1 for r in results if r["error"] is None)
+    return {
+        "teachers": n_teachers,
+        "ok": ok,
+        "failed": n_teachers - ok,
+        "errors": [r["error"] for r in results if r["error"]],
+        "wall_s": wall,
+        "flows_per_s": ok / wall if wall else 0.0,
+        "reruns_per_s": len(timings) / wall if wall else 0.0,
+        "rerun_p50_ms": percentile(timings, 50) * 1000,
+        "rerun_p90_ms": percentile(timings, 90) * 1000,
+        "rerun_p99_ms": percentile(timings, 99) * 1000,
+        "rerun_max_ms": max(timings, default=0.0) * 1000,
+        "peak_rss_mb": None if sampler.peak is None else sampler.peak / 1024 / 1024,
+        "rss_growth_mb": None if sampler.growth is None else sampler.growth / 1024 / 1024,
+        "max_history_kb": max(r["history_memory"] for r in results) / 1024,
+        "max_download_kb": max(r["download_bytes"] for r in results) / 1024,
+    }
+
+
+def run_level_in_subprocess(n_teachers, args):
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        "--level-worker", str(n_teachers),
+        "--latency", str(args.latency),
+        "--jitter", str(args.jitter),
+        "--timeout", str(args.timeout),
+    ]
+    proc = subprocess.run(command, capture_output=True, text=True, encoding="utf-8", errors="replace")
+    lines = [line for line in proc.stdout.splitlines() if line.strip()]
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, ValueError):
+        # 子プロセスごと落ちた場合は全員失敗として扱う
+        detail = proc.stderr.strip().splitlines()[-1:] or [f"終了コード {proc.returncode}"]
+        return {
+            "teachers": n_teachers, "ok": 0, "failed": n_teachers,
+            "errors": [f"プロセス異常終了: {detail[0]}"],
+            "wall_s": 0.0, "flows_per_s": 0.0, "reruns_per_s": 0.0,
+            "rerun_p50_ms": 0.0, "rerun_p90_ms": 0.0, "rerun_p99_ms": 0.0, "rerun_max_ms": 0.0,
+            "peak_rss_mb": None, "rss_growth_mb": None,
+            "max_history_kb": 0.0, "max_download_kb": 0.0,
+        }
+
+
+def run_level_worker(n_teachers, args):
+    passwords = {f"teacher{i}": f"pw{i}" for i in range(n_teachers)}
+
+    # app.py は tempfile.gettempdir() の下にPDFの保存領域を作るので、使い捨てのフォルダに向ける
+    work_dir = tempfile.mkdtemp(prefix="english_app_loadtest_")
+    tempfile.tempdir = work_dir
+
+    server = start_stub_server(args.latency, args.jitter)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+
+    # AppTest に secrets を渡すと実行ごとに st.secrets を差し替えて戻すため、並列実行すると競合する。
+    # 全員共通のSecretsを最初に1度だけ設定しておく。
+    secrets = Secrets()
+    secrets._secrets = {"passwords": passwords, "OPENAI_API_KEY": "stub"}
+    st.secrets = secrets
+
+    # app.py はフォントや参照資料を相対パスで探すので、アプリのフォルダで実行する
+    os.chdir(APP_DIR)
+    try:
+        install_concurrency_patches()
+        row = run_level(n_teachers, passwords, args.timeout)
+    finally:
+        server.shutdown()
+        tempfile.tempdir = None
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps(row))
+
+
+def format_mb(value):
+    return "n/a" if value is None else f"{value:.1f}"
+
+
+def print_table(rows):
+    header = f"{'先生':>4} {'成功':>4} {'失敗':>4} {'所要(s)':>8} {'完了/s':>7} {'rerun/s':>8} " \
+             f"{'p50(ms)':>8} {'p90(ms)':>8} {'p99(ms)':>8} {'max(ms)':>8} {'RSS(MB)':>8} {'増分(MB)':>8} " \
+             f"{'履歴(KB)':>8} {'DL(KB)':>8}"
+    print(header)
+    for r in rows:
+        print(f"{r['teachers']:>4} {r['ok']:>4} {r['failed']:>4} {r['wall_s']:>8.2f} {r['flows_per_s']:>7.2f} "
+              f"{r['reruns_per_s']:>8.2f} {r['rerun_p50_ms']:>8.0f} {r['rerun_p90_ms']:>8.0f} "
+              f"{r['rerun_p99_ms']:>8.0f} {r['rerun_max_ms']:>8.0f} {format_mb(r['peak_rss_mb']):>8} "
+              f"{format_mb(r['rss_growth_mb']):>8} {r['max_history_kb']:>8.1f} {r['max_download_kb']:>8.1f}")
+        for error in r["errors"][:3]:
+            print(f"     エラー: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="app.py の同時利用負荷テスト")
+    parser.add_argument("--teachers", default="1,5,10", help="同時利用する先生の人数 (カンマ区切りで段階指定)")
+    parser.add_argument("--latency", type=float, default=1.0, help="スタブモデルの応答遅延 (秒)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="応答遅延のばらつき (±秒)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="1回の再実行のタイムアウト (秒)")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    parser.add_argument("--level-worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not st.__version__.startswith(TESTED_STREAMLIT_VERSION + "."):
+        print(
+            f"エラー: この負荷テストは Streamlit {TESTED_STREAMLIT_VERSION}.x の内部APIを前提にしています "
+            f"(インストール済み: {st.__version__})。"
+            f"新しいバージョンで動作を確認してから TESTED_STREAMLIT_VERSION を更新してください。",
+            file=sys.stderr,
+        )
+        return 2
+
+    if args.level_worker is not None:
+        run_level_worker(args.level_worker, args)
+        return 0
+
+    levels = [int(n) for n in args.teachers.split(",") if n.strip()]
+    rows = []
+    for n in levels:
+        if not args.json:
+            print(f"[{datetime.datetime.now():%H:%M:%S}] {n}人で実行中...", file=sys.stderr)
+        rows.append(run_level_in_subprocess(n, args))
+
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+    else:
+        print_table(rows)
+
+    return 1 if any(r["failed"] for r in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())